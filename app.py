@@ -1,11 +1,8 @@
 import streamlit as st
 import pandas as pd
-import time
-from datetime import datetime, timedelta
-import pytz
+from datetime import timedelta
 from stock_data import get_volume_data, get_market_caps, get_nse_bse_symbols
 from utils import is_market_open, get_current_time_ist, format_market_cap
-import sample_data
 
 # Set page config
 st.set_page_config(
@@ -29,26 +26,55 @@ if 'filtered_stocks' not in st.session_state:
 if 'last_update_time' not in st.session_state:
     st.session_state.last_update_time = None
 
-if 'symbols' not in st.session_state:
-    st.session_state.symbols = None
-    
 if 'using_sample_data' not in st.session_state:
     st.session_state.using_sample_data = False
 
+# Refresh interval the stored results were loaded in, and whether "Refresh Now" was clicked
+if 'loaded_time_bucket' not in st.session_state:
+    st.session_state.loaded_time_bucket = None
+
+if 'refresh_requested' not in st.session_state:
+    st.session_state.refresh_requested = False
+
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def fetch_symbols():
+    """Stock symbols, cached across reruns and sessions for a day"""
+    return get_nse_bse_symbols()
+
+
+@st.cache_data(ttl=1800, show_spinner=False)
+def fetch_volume_data(symbols, time_bucket):
+    """
+    Volume data, cached so reruns within the same refresh interval reuse one download
+    
+    Only data goes through this cache: it is shared by all sessions, so it must not
+    touch session state or UI elements created outside it.
+    
+    Args:
+        symbols: Dictionary mapping symbols to company names
+        time_bucket: Index of the current refresh interval; a new bucket forces a fresh download
+        
+    Returns:
+        Tuple of (volume DataFrame, whether sample data was used)
+    """
+    return get_volume_data(symbols)
 
-def load_and_filter_stocks():
+
+def load_and_filter_stocks(refresh_interval):
     """Load stock data, apply filters, and update the session state"""
     with st.spinner("Fetching stock symbols..."):
-        if st.session_state.symbols is None:
-            st.session_state.symbols = get_nse_bse_symbols()
+        symbols = fetch_symbols()
     
-    if not st.session_state.symbols:
+    if not symbols:
         st.error("Failed to fetch stock symbols. Please try again later.")
         return
     
-    symbols = st.session_state.symbols
     current_time = get_current_time_ist()
     
+    # The sample data flag describes the results loaded below
+    st.session_state.using_sample_data = False
+    
     # Status message
     status_col1, status_col2 = st.columns(2)
     with status_col1:
@@ -64,7 +90,11 @@ def load_and_filter_stocks():
     
     # Get volume data for all symbols
     processing_text.text(f"Fetching volume data for {len(symbols)} stocks...")
-    volume_data = get_volume_data(symbols, progress_callback=lambda x: progress_bar.progress(x * 0.7))
+    time_bucket = int(current_time.timestamp() // (refresh_interval * 60))
+    volume_data, used_sample_data = fetch_volume_data(symbols, time_bucket)
+    progress_bar.progress(0.7)
+    if used_sample_data:
+        st.session_state.using_sample_data = True
     
     if volume_data.empty:
         st.error("Failed to fetch volume data. Please try again later.")
@@ -72,36 +102,48 @@ def load_and_filter_stocks():
     
     # Filter stocks with volume spike ratio >= 10
     processing_text.text("Filtering stocks based on volume spike...")
-    volume_filtered = volume_data[volume_data['volume_spike_ratio'] >= 10].copy()
+    volume_filtered = volume_data[volume_data['volume_spike_ratio'] >= 10]
     
     if volume_filtered.empty:
         st.warning("No stocks meet the volume spike criteria at this time.")
         st.session_state.filtered_stocks = pd.DataFrame()
         st.session_state.last_update_time = current_time
+        st.session_state.loaded_time_bucket = time_bucket
         progress_bar.progress(1.0)
         processing_text.empty()
         return
     
-    # Get market caps
+    # Get market caps in order of current volume, stopping once 10 stocks pass the market cap filter
     processing_text.text("Fetching market cap data...")
-    market_caps = get_market_caps(volume_filtered.index.tolist(), 
-                                 progress_callback=lambda x: progress_bar.progress(0.7 + x * 0.3))
+    candidates = volume_filtered.sort_values('current_volume', ascending=False).index.tolist()
+    market_cap_batches = []
+    qualifying_count = 0
+    
+    for i in range(0, len(candidates), 20):
+        batch = candidates[i:i+20]
+        batch_market_caps = get_market_caps(batch)
+        market_cap_batches.append(batch_market_caps)
+        qualifying_count += (batch_market_caps['market_cap_cr'] > 1000).sum()
+        progress_bar.progress(0.7 + min(1.0, (i + len(batch)) / len(candidates)) * 0.3)
+        
+        if qualifying_count >= 10:
+            break
+    
+    market_caps = pd.concat(market_cap_batches)
     
     # Merge volume data with market caps
     volume_filtered = volume_filtered.join(market_caps)
     
     # Filter by market cap > 1000 crore
-    filtered_stocks = volume_filtered[volume_filtered['market_cap_cr'] > 1000].copy()
+    filtered_stocks = volume_filtered[volume_filtered['market_cap_cr'] > 1000]
     
     # Sort by current volume (descending) and take top 10
     filtered_stocks = filtered_stocks.sort_values('current_volume', ascending=False).head(10)
     
-    # Format market cap
-    filtered_stocks['market_cap_cr'] = filtered_stocks['market_cap_cr'].apply(format_market_cap)
-    
     # Update session state
     st.session_state.filtered_stocks = filtered_stocks
     st.session_state.last_update_time = current_time
+    st.session_state.loaded_time_bucket = time_bucket
     
     # Clear progress indicators
     progress_bar.progress(1.0)
@@ -118,20 +160,28 @@ with col2:
                                    options=[1, 5, 10, 15, 30], 
                                    index=1)
 
-# Manual refresh button
+# Manual refresh button: drop cached volume data so the results below re-download it
 if st.button("Refresh Now"):
-    load_and_filter_stocks()
+    fetch_volume_data.clear()
+    st.session_state.refresh_requested = True
 
-# Auto-refresh logic
-if auto_refresh:
-    # Check if it's time to refresh
-    current_time = get_current_time_ist()
-    if (st.session_state.last_update_time is None or 
-        (current_time - st.session_state.last_update_time).total_seconds() >= refresh_interval * 60):
-        load_and_filter_stocks()
 
-# Display results
-if not st.session_state.filtered_stocks.empty:
+@st.fragment(run_every=timedelta(minutes=refresh_interval) if auto_refresh else None)
+def results_fragment():
+    """Refresh and display the results; with auto-refresh on, only this part reruns on its timer"""
+    # Other widget interactions rerun this too, so reload only on the first run, on "Refresh Now",
+    # or when the auto-refresh timer has moved us into a new refresh interval
+    time_bucket = int(get_current_time_ist().timestamp() // (refresh_interval * 60))
+    if (st.session_state.last_update_time is None or st.session_state.refresh_requested or
+            (auto_refresh and st.session_state.loaded_time_bucket != time_bucket)):
+        st.session_state.refresh_requested = False
+        load_and_filter_stocks(refresh_interval)
+    
+    if st.session_state.filtered_stocks.empty:
+        if st.session_state.last_update_time:
+            st.info("No stocks currently meet the filtering criteria. Try refreshing later.")
+        return
+    
     st.subheader("Top 10 Stocks with Volume Spikes")
     
     if st.session_state.last_update_time:
@@ -145,12 +195,10 @@ if not st.session_state.filtered_stocks.empty:
         Yahoo Finance API is experiencing connection issues. Please try again later for real-time data.
         """)
     
-    # Reset the sample data flag for next refresh
-    st.session_state.using_sample_data = False
-    
     # Rename columns for display
     display_df = st.session_state.filtered_stocks.reset_index().rename(columns={
         'index': 'Symbol',
+        'symbol': 'Symbol',
         'name': 'Company Name',
         'current_volume': 'Current 5-Minute Volume',
         'avg_volume_prev_day': 'Avg Volume (Prev Day, 10x5min)',
@@ -166,14 +214,14 @@ if not st.session_state.filtered_stocks.empty:
     # Format the volume spike ratio to 2 decimal places
     display_df['Volume Spike Ratio'] = display_df['Volume Spike Ratio'].apply(lambda x: f"{x:.2f}x")
     
+    # Format market cap
+    display_df['Market Cap (₹ Cr)'] = display_df['Market Cap (₹ Cr)'].map(format_market_cap)
+    
     # Display the dataframe
     st.dataframe(display_df, use_container_width=True)
-else:
-    if st.session_state.last_update_time:
-        st.info("No stocks currently meet the filtering criteria. Try refreshing later.")
-    else:
-        # Initial load
-        load_and_filter_stocks()
+
+
+results_fragment()
 
 # Add information about the criteria
 st.subheader("Screening Criteria")
@@ -2,12 +2,14 @@
 Sample stock data to use when Yahoo Finance API is unavailable.
 This ensures the application can demonstrate its functionality even when
 external data sources are down or unavailable.
+
+Sample frames are generated once per process and cached; the public
+functions return copies so callers can modify them freely.
 """
 
+from functools import lru_cache
 import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta
-import pytz
 
 def get_sample_symbols():
     """Return a dictionary of sample symbols and company names."""
@@ -35,7 +37,8 @@ def get_sample_symbols():
         'NTPC.NS': 'NTPC Limited'
     }
 
-def get_sample_volume_data():
+@lru_cache(maxsize=1)
+def _generate_sample_volume_data():
     """
     Generate sample volume data to demonstrate volume spike filtering.
     
@@ -71,37 +74,45 @@ def get_sample_volume_data():
     df = pd.DataFrame(data)
     df = df.set_index('symbol')
     
+    # Match the integer volume dtypes produced for live data
+    for column in ('current_volume', 'avg_volume_prev_day'):
+        df[column] = pd.to_numeric(df[column], downcast='integer')
+    
     return df
 
-def get_sample_market_caps():
+def get_sample_volume_data():
+    """
+    Get sample volume data to demonstrate volume spike filtering.
+    
+    Returns:
+        DataFrame with synthetic volume data showing some stocks with volume spikes.
+    """
+    return _generate_sample_volume_data().copy()
+
+@lru_cache(maxsize=1)
+def _generate_sample_market_caps():
     """
     Generate sample market cap data.
     
     Returns:
         DataFrame with market cap data for sample symbols.
     """
+    # Use the same figures as the live fallback table so the two can never disagree;
+    # imported here because stock_data imports this module
+    from stock_data import FALLBACK_MARKET_CAPS, normalize_symbol
+    
     market_caps = {
-        'RELIANCE.NS': 18000,  # ~₹18,00,000 crore
-        'TCS.NS': 14000,       # ~₹14,00,000 crore
-        'HDFCBANK.NS': 12000,  # ~₹12,00,000 crore
-        'INFY.NS': 7000,       # ~₹7,00,000 crore
-        'ICICIBANK.NS': 7500,  # ~₹7,50,000 crore
-        'HINDUNILVR.NS': 6000, # ~₹6,00,000 crore
-        'SBIN.NS': 6500,       # ~₹6,50,000 crore
-        'BHARTIARTL.NS': 6200, # ~₹6,20,000 crore
-        'ITC.NS': 5500,        # ~₹5,50,000 crore
-        'KOTAKBANK.NS': 4200,  # ~₹4,20,000 crore
-        'LT.NS': 4000,         # ~₹4,00,000 crore
-        'BAJFINANCE.NS': 4500, # ~₹4,50,000 crore
-        'AXISBANK.NS': 3200,   # ~₹3,20,000 crore
-        'ASIANPAINT.NS': 3000, # ~₹3,00,000 crore
-        'MARUTI.NS': 3300,     # ~₹3,30,000 crore
-        'TITAN.NS': 2800,      # ~₹2,80,000 crore
-        'SUNPHARMA.NS': 2600,  # ~₹2,60,000 crore
-        'ULTRACEMCO.NS': 2500, # ~₹2,50,000 crore
-        'ULTRACEM.NS': 2500,   # ~₹2,50,000 crore (alternative symbol)
-        'TATASTEEL.NS': 2200,  # ~₹2,20,000 crore
-        'NTPC.NS': 2400        # ~₹2,40,000 crore
+        symbol: FALLBACK_MARKET_CAPS[normalize_symbol(symbol)]
+        for symbol in get_sample_symbols()
     }
     
-    return pd.DataFrame({'market_cap_cr': market_caps})
\ No newline at end of file
+    return pd.DataFrame({'market_cap_cr': market_caps})
+
+def get_sample_market_caps():
+    """
+    Get sample market cap data.
+    
+    Returns:
+        DataFrame with market cap data for sample symbols.
+    """
+    return _generate_sample_market_caps().copy()
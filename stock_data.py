@@ -1,13 +1,18 @@
 import pandas as pd
-import numpy as np
 import yfinance as yf
-from datetime import datetime, timedelta
-import pytz
+import platformdirs
+from datetime import datetime, timedelta, time as dt_time
 import time
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import concurrent.futures
-from utils import get_current_time_ist
+import os
+import json
+import re
+import threading
+from types import MappingProxyType
+from utils import get_current_time_ist, get_previous_trading_day, MARKET_OPEN_TIME
 import sample_data
 import logging
 
@@ -21,21 +26,166 @@ SYMBOL_CACHE = {
     'symbols': None
 }
 
-MARKET_CAP_CACHE = {
-    'timestamp': None,
-    'market_caps': {}
-}
+# Market caps expire per symbol: {symbol: (market_cap_cr, timestamp)}
+MARKET_CAP_CACHE = {}
+
+# Guards MARKET_CAP_CACHE; it is written from worker threads and concurrent Streamlit sessions
+MARKET_CAP_CACHE_LOCK = threading.RLock()
+
+# How long cached data stays valid: symbol lists change daily, market caps hourly
+SYMBOL_CACHE_TTL = 86400  # seconds
+MARKET_CAP_CACHE_TTL = 3600  # seconds
+# Symbols Yahoo has no market cap for are remembered briefly so they aren't re-queried every refresh
+NEGATIVE_MARKET_CAP_CACHE_TTL = 300  # seconds
+# Expired market caps younger than TTL + this window are served immediately while refreshing in the background
+MARKET_CAP_STALE_WINDOW = 3600  # seconds
+
+# Symbols with a background market cap refresh in flight, guarded by MARKET_CAP_CACHE_LOCK
+REFRESHING_MARKET_CAPS = set()
+
+# Both caches are persisted here so a restarted worker doesn't re-download everything.
+# The directory is per user and private, never the shared temp dir.
+CACHE_DIR = platformdirs.user_cache_dir('stock_screener')
+CACHE_FILE = os.path.join(CACHE_DIR, 'cache.json')
+# Bump whenever the cache file layout changes; files with another version are discarded
+CACHE_FORMAT_VERSION = 2
+
+# Candles of a finished trading day never change, so they are kept as parquet, one file per day
+HISTORY_CACHE_DIR = os.path.join(CACHE_DIR, 'history')
+# Only files named like this were written by save_cached_history, so only they are pruned
+HISTORY_CACHE_FILE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}\.parquet')
+
+class TokenBucket:
+    """Thread-safe token bucket limiting how fast requests are sent to Yahoo Finance"""
+    
+    def __init__(self, rate, capacity, min_rate=0.5, slowdown_period=60):
+        self.base_rate = rate  # tokens added per second
+        self.rate = rate
+        self.min_rate = min_rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.slowdown_period = slowdown_period  # seconds a reduced rate stays in effect
+        self.slowed_until = 0
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.rate < self.base_rate and now >= self.slowed_until:
+                    self.rate = self.base_rate
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+    
+    def back_off(self, seconds):
+        """Pause all requests and halve the rate for a while, e.g. after Yahoo responds with HTTP 429"""
+        with self.lock:
+            now = time.monotonic()
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.tokens = 0
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.slowed_until = now + self.slowdown_period
+
+class RateLimitedAdapter(HTTPAdapter):
+    """HTTPAdapter that takes a token before every request, applies a default timeout and retries 429s itself"""
+    
+    def send(self, request, **kwargs):
+        # Never let a stuck request hold a worker thread indefinitely
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = REQUEST_TIMEOUT
+        
+        # 429s are retried here rather than by urllib3, so every attempt takes a token
+        # and the whole process slows down instead of just this thread sleeping
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            RATE_LIMITER.acquire()
+            response = super().send(request, **kwargs)
+            if response.status_code != 429:
+                break
+            
+            try:
+                retry_after = float(response.headers.get('Retry-After', DEFAULT_RETRY_AFTER))
+            except ValueError:
+                retry_after = DEFAULT_RETRY_AFTER
+            logger.warning(f"Rate limited by Yahoo Finance, pausing requests for {retry_after:.0f}s")
+            RATE_LIMITER.back_off(retry_after)
+            
+            if attempt < RATE_LIMIT_RETRIES:
+                response.close()
+        
+        return response
+
+# Only sleep when we are actually sending requests faster than Yahoo allows
+RATE_LIMITER = TokenBucket(rate=10, capacity=20)
+DEFAULT_RETRY_AFTER = 5  # seconds, when a 429 has no Retry-After header
+RATE_LIMIT_RETRIES = 3  # extra attempts after a 429
+REQUEST_TIMEOUT = 15  # seconds per HTTP request
+
+# Shared HTTP session so every yfinance call reuses pooled keep-alive connections.
+# It lives at module level, so it survives Streamlit reruns within the process.
+# Retry transient server errors at the HTTP layer; 429s are left to the adapter's rate limiter.
+# urllib3 retries any response carrying Retry-After (including 429) unless told not to.
+HTTP_RETRY = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504],
+                   respect_retry_after_header=False, raise_on_status=False)
+# One persistent 429 must cost exactly RATE_LIMIT_RETRIES + 1 requests, each through the token bucket
+assert not HTTP_RETRY.is_retry('GET', 429, has_retry_after=True)
+
+SESSION = requests.Session()
+SESSION.mount('https://', RateLimitedAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=HTTP_RETRY
+))
+SESSION.headers['User-Agent'] = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/124.0 Safari/537.36'
+)
+
+# Previous-day average volume is taken from candles between market open and this time
+OPENING_WINDOW_END = dt_time(11, 0, 0)
+
+# Approximate exchange rate for converting USD market caps
+USD_TO_INR = 83
+
+# Yahoo Finance reports market caps for these exchanges in INR
+INR_SYMBOL_SUFFIXES = ('.NS', '.BO')
+
+# Upper bound on threads for I/O-bound Yahoo requests; the rate limiter caps actual throughput
+MAX_IO_WORKERS = 32
+
+# Number of tickers passed to each yf.download() call; yfinance still sends one history
+# request per ticker, on its own threads
+VOLUME_BATCH_SIZE = 20
+
+# yf.download collects results in the module-global yfinance.shared._DFS, so concurrent
+# calls (e.g. from two Streamlit sessions) would mix each other's tickers
+YF_DOWNLOAD_LOCK = threading.Lock()
+
+# Serve curated symbols from FALLBACK_MARKET_CAPS without a network call;
+# set STOCK_SCREENER_USE_FALLBACK_FIRST=0 to always query Yahoo Finance first
+USE_FALLBACK_FIRST = os.environ.get('STOCK_SCREENER_USE_FALLBACK_FIRST', '1') != '0'
+
+# Reference data below is built once at import and read-only
 
 # Updated symbol mappings with correct Yahoo Finance tickers
-SYMBOL_MAPPING = {
+SYMBOL_MAPPING = MappingProxyType({
     # Map common incorrect symbols to correct ones
     'ULTRACEM.NS': 'ULTRACEMCO.NS',
     'NTPC.NS': 'NTPC.NS',  # Keep this as is, but we'll handle it better
     'TATASTEEL.NS': 'TATASTEEL.NS',  # Keep this as is, but we'll handle it better
-}
+})
 
 # Define a list of reliable Indian stocks less likely to have API issues
-RELIABLE_SYMBOLS = [
+RELIABLE_SYMBOLS = (
     # Key NIFTY stocks that are most reliable for API calls - updated with correct symbols
     'RELIANCE.NS', 'TCS.NS', 'HDFCBANK.NS', 'INFY.NS', 'ICICIBANK.NS',
     'HINDUNILVR.NS', 'SBIN.NS', 'BHARTIARTL.NS', 'ITC.NS', 'KOTAKBANK.NS',
@@ -44,10 +194,10 @@ RELIABLE_SYMBOLS = [
     # Additional reliable symbols
     'WIPRO.NS', 'ONGC.NS', 'POWERGRID.NS', 'M&M.NS', 'ADANIENT.NS',
     'HCLTECH.NS', 'JSWSTEEL.NS', 'TECHM.NS', 'BAJAJFINSV.NS', 'APOLLOHOSP.NS'
-]
+)
 
 # Map of pre-defined company names to minimize API calls
-PREDEFINED_NAMES = {
+PREDEFINED_NAMES = MappingProxyType({
     'RELIANCE.NS': 'Reliance Industries',
     'TCS.NS': 'Tata Consultancy Services',
     'HDFCBANK.NS': 'HDFC Bank',
@@ -78,47 +228,186 @@ PREDEFINED_NAMES = {
     'TECHM.NS': 'Tech Mahindra',
     'BAJAJFINSV.NS': 'Bajaj Finserv',
     'APOLLOHOSP.NS': 'Apollo Hospitals'
-}
+})
 
 # Pre-defined market caps for fallback (in crores)
-FALLBACK_MARKET_CAPS = {
-    'RELIANCE.NS': 18000,   # ~₹18,00,000 crore
-    'TCS.NS': 14000,        # ~₹14,00,000 crore
-    'HDFCBANK.NS': 12000,   # ~₹12,00,000 crore
-    'INFY.NS': 7000,        # ~₹7,00,000 crore
-    'ICICIBANK.NS': 7500,   # ~₹7,50,000 crore
-    'HINDUNILVR.NS': 6000,  # ~₹6,00,000 crore
-    'SBIN.NS': 6500,        # ~₹6,50,000 crore
-    'BHARTIARTL.NS': 6200,  # ~₹6,20,000 crore
-    'ITC.NS': 5500,         # ~₹5,50,000 crore
-    'KOTAKBANK.NS': 4200,   # ~₹4,20,000 crore
-    'LT.NS': 4000,          # ~₹4,00,000 crore
-    'BAJFINANCE.NS': 4500,  # ~₹4,50,000 crore
-    'AXISBANK.NS': 3200,    # ~₹3,20,000 crore
-    'ASIANPAINT.NS': 3000,  # ~₹3,00,000 crore
-    'MARUTI.NS': 3300,      # ~₹3,30,000 crore
-    'TITAN.NS': 2800,       # ~₹2,80,000 crore
-    'SUNPHARMA.NS': 2600,   # ~₹2,60,000 crore
-    'ULTRACEMCO.NS': 2500,  # ~₹2,50,000 crore (corrected from ULTRACEM.NS)
-    'TATASTEEL.NS': 2200,   # ~₹2,20,000 crore
-    'NTPC.NS': 2400,        # ~₹2,40,000 crore
-    'WIPRO.NS': 2100,       # ~₹2,10,000 crore
-    'ONGC.NS': 2300,        # ~₹2,30,000 crore
-    'POWERGRID.NS': 1800,   # ~₹1,80,000 crore
-    'M&M.NS': 1900,         # ~₹1,90,000 crore
-    'ADANIENT.NS': 4800,    # ~₹4,80,000 crore
-    'HCLTECH.NS': 1700,     # ~₹1,70,000 crore
-    'JSWSTEEL.NS': 1600,    # ~₹1,60,000 crore
-    'TECHM.NS': 1200,       # ~₹1,20,000 crore
-    'BAJAJFINSV.NS': 2700,  # ~₹2,70,000 crore
-    'APOLLOHOSP.NS': 1100   # ~₹1,10,000 crore
-}
+FALLBACK_MARKET_CAPS = MappingProxyType({
+    'RELIANCE.NS': 1800000,   # ~₹18,00,000 crore
+    'TCS.NS': 1400000,        # ~₹14,00,000 crore
+    'HDFCBANK.NS': 1200000,   # ~₹12,00,000 crore
+    'INFY.NS': 700000,        # ~₹7,00,000 crore
+    'ICICIBANK.NS': 750000,   # ~₹7,50,000 crore
+    'HINDUNILVR.NS': 600000,  # ~₹6,00,000 crore
+    'SBIN.NS': 650000,        # ~₹6,50,000 crore
+    'BHARTIARTL.NS': 620000,  # ~₹6,20,000 crore
+    'ITC.NS': 550000,         # ~₹5,50,000 crore
+    'KOTAKBANK.NS': 420000,   # ~₹4,20,000 crore
+    'LT.NS': 400000,          # ~₹4,00,000 crore
+    'BAJFINANCE.NS': 450000,  # ~₹4,50,000 crore
+    'AXISBANK.NS': 320000,    # ~₹3,20,000 crore
+    'ASIANPAINT.NS': 300000,  # ~₹3,00,000 crore
+    'MARUTI.NS': 330000,      # ~₹3,30,000 crore
+    'TITAN.NS': 280000,       # ~₹2,80,000 crore
+    'SUNPHARMA.NS': 260000,   # ~₹2,60,000 crore
+    'ULTRACEMCO.NS': 250000,  # ~₹2,50,000 crore (corrected from ULTRACEM.NS)
+    'TATASTEEL.NS': 220000,   # ~₹2,20,000 crore
+    'NTPC.NS': 240000,        # ~₹2,40,000 crore
+    'WIPRO.NS': 210000,       # ~₹2,10,000 crore
+    'ONGC.NS': 230000,        # ~₹2,30,000 crore
+    'POWERGRID.NS': 180000,   # ~₹1,80,000 crore
+    'M&M.NS': 190000,         # ~₹1,90,000 crore
+    'ADANIENT.NS': 480000,    # ~₹4,80,000 crore
+    'HCLTECH.NS': 170000,     # ~₹1,70,000 crore
+    'JSWSTEEL.NS': 160000,    # ~₹1,60,000 crore
+    'TECHM.NS': 120000,       # ~₹1,20,000 crore
+    'BAJAJFINSV.NS': 270000,  # ~₹2,70,000 crore
+    'APOLLOHOSP.NS': 110000   # ~₹1,10,000 crore
+})
 
 def normalize_symbol(symbol):
     """Normalize Yahoo Finance symbols to handle common issues"""
-    if symbol in SYMBOL_MAPPING:
-        return SYMBOL_MAPPING[symbol]
-    return symbol
+    return SYMBOL_MAPPING.get(symbol, symbol)
+
+def is_cache_fresh(timestamp, ttl):
+    """Check if a cache entry written at timestamp is younger than ttl seconds"""
+    return timestamp is not None and (datetime.now() - timestamp).total_seconds() < ttl
+
+def is_market_cap_entry_fresh(entry, stale_window=0):
+    """
+    Check a (market_cap, timestamp) cache entry
+    
+    Misses (0) expire sooner than real values and are never served stale.
+    
+    Args:
+        entry: Tuple of (market cap in crores, timestamp)
+        stale_window: Extra seconds past the TTL during which a real value is still usable
+    """
+    market_cap, timestamp = entry
+    if market_cap > 0:
+        ttl = MARKET_CAP_CACHE_TTL + stale_window
+    else:
+        ttl = NEGATIVE_MARKET_CAP_CACHE_TTL
+    return is_cache_fresh(timestamp, ttl)
+
+def ensure_cache_dir(path):
+    """Create a cache directory readable only by the current user"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    os.chmod(path, 0o700)
+
+def load_disk_cache():
+    """Populate SYMBOL_CACHE and MARKET_CAP_CACHE from the on-disk cache file, skipping expired entries"""
+    try:
+        with open(CACHE_FILE, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        
+        if cached.get('version') != CACHE_FORMAT_VERSION:
+            logger.debug(f"Ignoring stock data cache with unknown format version {cached.get('version')}")
+            return
+        
+        symbols_timestamp = cached['symbols']['timestamp']
+        symbols_timestamp = datetime.fromisoformat(symbols_timestamp) if symbols_timestamp else None
+        if is_cache_fresh(symbols_timestamp, SYMBOL_CACHE_TTL):
+            SYMBOL_CACHE.update({'timestamp': symbols_timestamp, 'symbols': cached['symbols']['symbols']})
+        
+        market_caps = {
+            symbol: (market_cap, datetime.fromisoformat(timestamp))
+            for symbol, (market_cap, timestamp) in cached['market_caps'].items()
+        }
+        with MARKET_CAP_CACHE_LOCK:
+            MARKET_CAP_CACHE.update({
+                symbol: entry for symbol, entry in market_caps.items()
+                if is_market_cap_entry_fresh(entry, MARKET_CAP_STALE_WINDOW)
+            })
+        logger.info(f"Loaded stock data cache from {CACHE_FILE}")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Could not load stock data cache: {e}")
+
+def save_disk_cache():
+    """Write SYMBOL_CACHE and MARKET_CAP_CACHE to the on-disk cache file, pruning expired market caps"""
+    with MARKET_CAP_CACHE_LOCK:
+        expired = [symbol for symbol, entry in MARKET_CAP_CACHE.items()
+                   if not is_market_cap_entry_fresh(entry, MARKET_CAP_STALE_WINDOW)]
+        for symbol in expired:
+            del MARKET_CAP_CACHE[symbol]
+        market_caps = {
+            symbol: [float(market_cap), timestamp.isoformat()]
+            for symbol, (market_cap, timestamp) in MARKET_CAP_CACHE.items()
+        }
+    
+    symbols_timestamp = SYMBOL_CACHE['timestamp']
+    payload = {
+        'version': CACHE_FORMAT_VERSION,
+        'symbols': {
+            'timestamp': symbols_timestamp.isoformat() if symbols_timestamp else None,
+            'symbols': SYMBOL_CACHE['symbols']
+        },
+        'market_caps': market_caps
+    }
+    
+    try:
+        ensure_cache_dir(CACHE_DIR)
+        tmp_file = f"{CACHE_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(payload, f)
+        # Atomic rename so concurrent readers never see a partial file
+        os.replace(tmp_file, CACHE_FILE)
+    except Exception as e:
+        logger.warning(f"Could not save stock data cache: {e}")
+
+# Warm the in-memory caches from a previous process
+load_disk_cache()
+
+def get_cached_market_cap(symbol, stale_window=0):
+    """Return the cached market cap for a normalized symbol, or None if missing or expired"""
+    with MARKET_CAP_CACHE_LOCK:
+        entry = MARKET_CAP_CACHE.get(symbol)
+    if entry is not None and is_market_cap_entry_fresh(entry, stale_window):
+        return entry[0]
+    return None
+
+def invalidate_market_cap(symbol):
+    """Drop a symbol's cached market cap so the next lookup refetches it (e.g. after a corporate action)"""
+    with MARKET_CAP_CACHE_LOCK:
+        MARKET_CAP_CACHE.pop(normalize_symbol(symbol), None)
+
+def set_cached_market_caps(market_caps):
+    """Store market caps keyed by normalized symbol under one lock acquisition and timestamp"""
+    timestamp = datetime.now()
+    with MARKET_CAP_CACHE_LOCK:
+        MARKET_CAP_CACHE.update({symbol: (market_cap, timestamp) for symbol, market_cap in market_caps.items()})
+
+def refresh_market_caps_in_background(symbols):
+    """Refetch stale market caps on a daemon thread, skipping symbols already being refreshed"""
+    with MARKET_CAP_CACHE_LOCK:
+        symbols = [s for s in symbols if s not in REFRESHING_MARKET_CAPS]
+        REFRESHING_MARKET_CAPS.update(symbols)
+    
+    if not symbols:
+        return
+    
+    def refresh():
+        refreshed = {}
+        try:
+            for symbol in symbols:
+                # One failing symbol must not throw away the rest of the refresh
+                try:
+                    market_cap = get_market_cap(symbol, use_cache=False)
+                except Exception as e:
+                    logger.warning(f"Background market cap refresh failed for {symbol}: {e}")
+                    continue
+                # get_market_cap reports failures as 0; keep serving the stale value rather than a miss
+                if market_cap > 0:
+                    refreshed[symbol] = market_cap
+            set_cached_market_caps(refreshed)
+            save_disk_cache()
+        finally:
+            with MARKET_CAP_CACHE_LOCK:
+                REFRESHING_MARKET_CAPS.difference_update(symbols)
+    
+    logger.info(f"Refreshing {len(symbols)} stale market caps in the background")
+    threading.Thread(target=refresh, daemon=True).start()
 
 def get_nse_bse_symbols():
     """
@@ -126,26 +415,21 @@ def get_nse_bse_symbols():
     Returns a dictionary mapping symbols to company names
     """
     # Check if we have a recent cache (less than 1 day old)
-    if (SYMBOL_CACHE['timestamp'] is not None and 
-        (datetime.now() - SYMBOL_CACHE['timestamp']).total_seconds() < 86400 and
-        SYMBOL_CACHE['symbols'] is not None):
+    if is_cache_fresh(SYMBOL_CACHE['timestamp'], SYMBOL_CACHE_TTL) and SYMBOL_CACHE['symbols'] is not None:
         return SYMBOL_CACHE['symbols']
     
     try:
-        # Start with reliable symbols list
-        nse_symbols = {}
-        
-        # Use the predefined list and names
-        for symbol in RELIABLE_SYMBOLS:
-            normalized_symbol = normalize_symbol(symbol)
-            if normalized_symbol in PREDEFINED_NAMES:
-                nse_symbols[normalized_symbol] = PREDEFINED_NAMES[normalized_symbol]
-            else:
-                nse_symbols[normalized_symbol] = normalized_symbol.replace('.NS', '')
+        # Use the reliable symbols list with predefined names
+        normalized_symbols = [normalize_symbol(symbol) for symbol in RELIABLE_SYMBOLS]
+        nse_symbols = {
+            symbol: PREDEFINED_NAMES.get(symbol, symbol.replace('.NS', ''))
+            for symbol in normalized_symbols
+        }
         
         # Cache the results immediately - we'll use what we have even if partial
         SYMBOL_CACHE['timestamp'] = datetime.now()
         SYMBOL_CACHE['symbols'] = nse_symbols
+        save_disk_cache()
         
         logger.info(f"Loaded {len(nse_symbols)} stock symbols")
         return nse_symbols
@@ -163,276 +447,327 @@ def get_nse_bse_symbols():
         SYMBOL_CACHE['symbols'] = minimal_symbols
         return minimal_symbols
 
-def get_history_with_fallback(ticker, start, end=None, interval="5m", max_retries=3):
-    """Get historical data with fallback and retries"""
-    retry_delay = 1  # seconds
-    
-    for attempt in range(max_retries):
-        try:
-            params = {
-                'start': start,
-                'interval': interval
-            }
-            if end:
-                params['end'] = end
-                
-            data = ticker.history(**params)
-            
-            if not data.empty:
-                return data
-            
-            # Empty data, try again after delay
-            logger.warning(f"Empty data for {ticker.ticker} on attempt {attempt+1}")
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay)
-                
-        except Exception as e:
-            logger.warning(f"Attempt {attempt+1} failed for {ticker.ticker}: {str(e)}")
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay)
+def history_cache_path(day):
+    """Path of the parquet file holding the cached candles for one trading day"""
+    return os.path.join(HISTORY_CACHE_DIR, f"{day.isoformat()}.parquet")
+
+def load_cached_history(day):
+    """
+    Load the candles of a finished trading day saved by save_cached_history
     
-    # All attempts failed
-    return pd.DataFrame()
+    Returns:
+        DataFrame with 'ts', 'symbol' and 'Volume' columns, empty if nothing is cached
+    """
+    try:
+        return pd.read_parquet(history_cache_path(day))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Could not load cached history for {day}: {e}")
+    return pd.DataFrame(columns=['ts', 'symbol', 'Volume'])
 
-def is_valid_volume_data(data):
-    """Check if volume data is valid"""
-    if data is None or data.empty:
-        return False
-        
-    # Check if Volume column exists and has non-zero values
-    if 'Volume' not in data.columns:
-        return False
-        
-    # Check if there are any significant volumes
-    if data['Volume'].sum() < 100:  # Arbitrary low threshold
-        return False
+def save_cached_history(day, history):
+    """Write the candles of a finished trading day to disk and drop files of older days"""
+    path = history_cache_path(day)
+    try:
+        ensure_cache_dir(CACHE_DIR)
+        ensure_cache_dir(HISTORY_CACHE_DIR)
+        tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        history.to_parquet(tmp_file, index=False)
+        # Atomic rename so concurrent readers never see a partial file
+        os.replace(tmp_file, path)
         
-    return True
+        for file_name in os.listdir(HISTORY_CACHE_DIR):
+            if HISTORY_CACHE_FILE_PATTERN.fullmatch(file_name) and file_name != os.path.basename(path):
+                os.remove(os.path.join(HISTORY_CACHE_DIR, file_name))
+    except Exception as e:
+        logger.warning(f"Could not save cached history for {day}: {e}")
 
-def fetch_volume_data_for_symbol(symbol_info):
-    """Fetch volume data for a single symbol with improved error handling"""
-    symbol, name = symbol_info
-    normalized_symbol = normalize_symbol(symbol)
+def download_history(symbols, start, end=None, interval="5m"):
+    """
+    Download historical data for a chunk of symbols with one yf.download() call
+    
+    yfinance fetches each ticker separately on its own threads; calls are serialized
+    with YF_DOWNLOAD_LOCK because yf.download is not thread-safe. Transient HTTP
+    errors are retried by the shared session's adapter.
+    
+    Returns:
+        DataFrame from yf.download, or an empty DataFrame if the download failed
+    """
+    params = {
+        'tickers': " ".join(symbols),
+        'start': start,
+        'interval': interval,
+        'group_by': 'ticker',
+        'threads': True,
+        'progress': False,
+        'prepost': False,
+        'timeout': REQUEST_TIMEOUT,
+        'session': SESSION
+    }
+    if end:
+        params['end'] = end
     
     try:
-        # Current time in IST
-        current_time_ist = get_current_time_ist()
-        
-        # Previous trading day (accounting for weekends)
-        days_to_subtract = 1
-        prev_day = current_time_ist - timedelta(days=days_to_subtract)
-        while prev_day.weekday() >= 5:  # 5 is Saturday, 6 is Sunday
-            days_to_subtract += 1
-            prev_day = current_time_ist - timedelta(days=days_to_subtract)
-        
-        # Prepare date strings
-        prev_day_str = prev_day.strftime('%Y-%m-%d')
-        next_day_str = (prev_day + timedelta(days=1)).strftime('%Y-%m-%d')
-        current_day_str = current_time_ist.strftime('%Y-%m-%d')
-        
-        # Create ticker object
-        ticker = yf.Ticker(normalized_symbol)
-        
-        # Get previous day's data with improved fallback
-        prev_day_data = get_history_with_fallback(
-            ticker,
-            start=prev_day_str,
-            end=next_day_str,
-            interval="5m"
-        )
-        
-        if not is_valid_volume_data(prev_day_data):
-            logger.warning(f"Invalid prev day data for {normalized_symbol}")
-            return None
-            
-        # Market hours in IST for filtering
-        market_open_hour, market_open_minute = 9, 15
-        market_end_hour, market_end_minute = 11, 0
-            
-        # Try different methods to filter data between market hours
-        filtered_data = pd.DataFrame()
-        
-        # Method 1: Try hour/minute filtering
-        try:
-            filtered_data = prev_day_data[
-                ((prev_day_data.index.hour > market_open_hour) | 
-                 ((prev_day_data.index.hour == market_open_hour) & (prev_day_data.index.minute >= market_open_minute))) &
-                ((prev_day_data.index.hour < market_end_hour) | 
-                 ((prev_day_data.index.hour == market_end_hour) & (prev_day_data.index.minute <= market_end_minute)))
-            ]
-        except Exception as e:
-            logger.warning(f"Hour/minute filtering failed for {normalized_symbol}: {e}")
-            
-        # Method 2: If that failed, try string-based filtering
-        if filtered_data.empty:
-            filtered_rows = []
-            filtered_indices = []
-            
-            for idx, row in prev_day_data.iterrows():
-                try:
-                    time_str = str(idx.time()) if hasattr(idx, 'time') else str(idx)
-                    if ('09:' in time_str and int(time_str.split(':')[1][:2]) >= 15) or '10:' in time_str:
-                        filtered_rows.append(row)
-                        filtered_indices.append(idx)
-                except Exception:
-                    pass
-            
-            if filtered_rows:
-                filtered_data = pd.DataFrame(filtered_rows, index=filtered_indices)
-        
-        # Take the first 10 candles or as many as available
-        filtered_data = filtered_data.head(10)
+        with YF_DOWNLOAD_LOCK:
+            data = yf.download(**params)
+    except Exception as e:
+        logger.warning(f"Download failed for batch of {len(symbols)} symbols: {str(e)}")
+        return pd.DataFrame()
+    
+    if data is None or data.empty:
+        logger.warning(f"Empty data for batch of {len(symbols)} symbols")
+        return pd.DataFrame()
+    
+    return data
+
+def stack_volume_history(data, symbols):
+    """
+    Reshape a multi-ticker download into long form
+    
+    Args:
+        data: DataFrame returned by yf.download for one chunk
+        symbols: Symbols requested in that chunk
         
-        if len(filtered_data) < 3:  # Need at least 3 candles for a reasonable average
-            logger.warning(f"Insufficient data points for {normalized_symbol}")
-            return None
+    Returns:
+        DataFrame with 'ts', 'symbol' and 'Volume' columns, timestamps in IST
+    """
+    if data is None or data.empty:
+        return pd.DataFrame(columns=['ts', 'symbol', 'Volume'])
+    
+    if isinstance(data.columns, pd.MultiIndex):
+        long_data = data.stack(level=0, future_stack=True).rename_axis(['ts', 'symbol']).reset_index()
+    else:
+        # Older yfinance versions return flat columns for a single ticker
+        long_data = data.rename_axis('ts').reset_index().assign(symbol=symbols[0])
+    
+    # Keep only the tickers this chunk asked for
+    long_data = long_data.loc[long_data['symbol'].isin(symbols), ['ts', 'symbol', 'Volume']]
+    long_data = long_data.dropna(subset=['Volume'])
+    
+    # Yahoo reports whole-number volumes as float64; downcast to the smallest integer type
+    long_data['Volume'] = pd.to_numeric(long_data['Volume'], downcast='integer')
+    
+    # Make sure candles are in IST so market-hour filtering lines up
+    if long_data['ts'].dt.tz is not None:
+        long_data['ts'] = long_data['ts'].dt.tz_convert('Asia/Kolkata')
+    
+    return long_data
+
+def average_opening_volume(prev_day_data):
+    """
+    Average volume of each symbol's first 10 candles between market open and 11:00 AM
+    
+    Args:
+        prev_day_data: Long-form candles of the previous trading day
         
-        # Calculate average volume
-        avg_volume = filtered_data['Volume'].mean()
-        if avg_volume == 0:
-            logger.warning(f"Zero average volume for {normalized_symbol}")
-            return None
-            
-        # Get current day data
-        current_day_data = get_history_with_fallback(
-            ticker,
-            start=current_day_str,
-            interval="5m"
-        )
+    Returns:
+        Series indexed by symbol; NaN where there is too little data for a reasonable average
+    """
+    # Take the first 10 candles between market open and 11:00 AM
+    opening_rows = pd.DatetimeIndex(prev_day_data['ts']).indexer_between_time(MARKET_OPEN_TIME, OPENING_WINDOW_END)
+    opening_data = prev_day_data.iloc[opening_rows]
+    opening_volume = opening_data.groupby('symbol').head(10).groupby('symbol')['Volume']
+    
+    avg_volume = opening_volume.mean()
+    valid_avg = (
+        (opening_volume.size() >= 3) &  # Need at least 3 candles for a reasonable average
+        (avg_volume > 0) &
+        (prev_day_data.groupby('symbol')['Volume'].sum().reindex(avg_volume.index) >= 100)
+    )
+    return avg_volume.where(valid_avg)
+
+def calculate_volume_spikes(history, symbols_dict, prev_day, current_day):
+    """
+    Calculate volume spike ratios for all symbols at once from already downloaded candles
+    
+    Args:
+        history: Long-form DataFrame from stack_volume_history
+        symbols_dict: Dictionary mapping normalized symbols to company names
+        prev_day: date of the previous trading day
+        current_day: date of the current day
         
-        if not is_valid_volume_data(current_day_data):
-            logger.warning(f"Invalid current day data for {normalized_symbol}")
-            return None
-            
-        # Get the latest 5-minute candle
-        if len(current_day_data) > 0:
-            current_candle = current_day_data.iloc[-1]
-            current_volume = current_candle['Volume']
-            
-            # Ignore if volume is unrealistically low
-            if current_volume <= 0:
-                logger.warning(f"Zero or negative current volume for {normalized_symbol}")
-                return None
-                
-            # Calculate volume spike ratio
-            volume_spike_ratio = current_volume / avg_volume
-            
-            return {
-                'symbol': normalized_symbol,
-                'name': name,
-                'current_volume': current_volume,
-                'avg_volume_prev_day': avg_volume,
-                'volume_spike_ratio': volume_spike_ratio
-            }
-        else:
-            logger.warning(f"No current day candles for {normalized_symbol}")
-            return None
+    Returns:
+        DataFrame indexed by symbol with volume data and spike ratios; symbols
+        with insufficient data are dropped
+    """
+    candle_dates = history['ts'].dt.date
+    prev_day_data = history[candle_dates == prev_day]
+    current_day_data = history[candle_dates == current_day]
     
-    except Exception as e:
-        logger.error(f"Error processing {normalized_symbol}: {e}")
-        return None
+    avg_volume = average_opening_volume(prev_day_data)
+    
+    # Latest 5-minute candle; ignore if volume is unrealistically low
+    current_volume = current_day_data.groupby('symbol')['Volume'].last()
+    valid_current = (
+        (current_volume > 0) &
+        (current_day_data.groupby('symbol')['Volume'].sum() >= 100)
+    )
+    current_volume = current_volume.where(valid_current)
+    
+    df = pd.DataFrame({
+        'current_volume': current_volume,
+        'avg_volume_prev_day': avg_volume,
+        'volume_spike_ratio': current_volume / avg_volume
+    }).dropna()
+    # Masking invalid symbols made volumes float; they are whole numbers, so restore an integer dtype
+    df['current_volume'] = pd.to_numeric(df['current_volume'].astype('int64'), downcast='integer')
+    df.insert(0, 'name', df.index.map(symbols_dict))
+    df.index.name = 'symbol'
+    
+    skipped = len(symbols_dict) - len(df)
+    if skipped:
+        logger.warning(f"Insufficient volume data for {skipped} symbols")
+    
+    return df
 
 def get_volume_data(symbols_dict, progress_callback=None):
     """
     Get volume data for all symbols and calculate volume spike ratios with improved reliability
     
+    Symbols are downloaded in chunks, one yf.download() call at a time, with a single
+    history request per symbol covering both days instead of two. Previous-day candles
+    are cached on disk, so once they are known only the current day is downloaded.
+    
     Args:
         symbols_dict: Dictionary mapping symbols to company names
         progress_callback: Function to call with progress (0.0 to 1.0)
         
     Returns:
-        DataFrame with volume data and spike ratios
+        Tuple of (DataFrame with volume data and spike ratios, whether sample data was used)
     """
-    results = []
-    symbols_list = list(symbols_dict.items())
+    normalized_names = {normalize_symbol(symbol): name for symbol, name in symbols_dict.items()}
+    symbols_list = list(normalized_names)
     total_symbols = len(symbols_list)
     
-    # Process symbols with better parallelism
-    batch_size = 10  # Smaller batch size to avoid overloading
-    for i in range(0, total_symbols, batch_size):
-        batch = symbols_list[i:i+batch_size]
-        
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            batch_results = list(executor.map(fetch_volume_data_for_symbol, batch))
-            
-            for result in batch_results:
-                if result is not None:
-                    results.append(result)
+    # Current time in IST
+    current_time_ist = get_current_time_ist()
+    
+    # Previous trading day (accounting for weekends)
+    prev_day = get_previous_trading_day(current_time_ist)
+    
+    prev_day_str = prev_day.strftime('%Y-%m-%d')
+    current_day_str = current_time_ist.strftime('%Y-%m-%d')
+    next_day_str = (current_time_ist + timedelta(days=1)).strftime('%Y-%m-%d')
+    
+    # Symbols with previous-day candles on disk only need today's candles
+    prev_day_cache = load_cached_history(prev_day.date())
+    cached_prev_history = prev_day_cache[prev_day_cache['symbol'].isin(symbols_list)]
+    cached_symbols = set(cached_prev_history['symbol'])
+    
+    # The rest get one download covering both the previous and the current trading day
+    uncached_symbols = [s for s in symbols_list if s not in cached_symbols]
+    current_only_symbols = [s for s in symbols_list if s in cached_symbols]
+    chunks = (
+        [(uncached_symbols[i:i+VOLUME_BATCH_SIZE], prev_day_str)
+         for i in range(0, len(uncached_symbols), VOLUME_BATCH_SIZE)] +
+        [(current_only_symbols[i:i+VOLUME_BATCH_SIZE], current_day_str)
+         for i in range(0, len(current_only_symbols), VOLUME_BATCH_SIZE)]
+    )
+    histories = [cached_prev_history] if not cached_prev_history.empty else []
+    new_prev_histories = []
+    
+    # Chunks are downloaded one after another: yf.download is not thread-safe, and it
+    # already fetches the tickers within a chunk in parallel
+    completed = 0
+    for chunk, start in chunks:
+        history = stack_volume_history(download_history(chunk, start=start, end=next_day_str), chunk)
+        if not history.empty:
+            histories.append(history)
+            if start == prev_day_str:
+                prev_history = history[history['ts'].dt.date == prev_day.date()]
+                # Only cache symbols that yield a usable average, so partial responses are retried
+                usable_symbols = average_opening_volume(prev_history).dropna().index
+                new_prev_histories.append(prev_history[prev_history['symbol'].isin(usable_symbols)])
         
         # Update progress
+        completed += len(chunk)
         if progress_callback:
-            progress_callback(min(1.0, (i + batch_size) / total_symbols))
-        
-        # Sleep to prevent rate limiting
-        time.sleep(1)
+            progress_callback(min(1.0, completed / total_symbols))
     
-    # Check if we got enough real data
-    if len(results) < 5:
-        logger.warning(f"Only found {len(results)} valid stocks. Using sample data.")
-        import streamlit as st
-        if 'using_sample_data' in st.session_state:
-            st.session_state.using_sample_data = True
-        sample_df = sample_data.get_sample_volume_data()
-        return sample_df
+    # Remember the newly downloaded previous-day candles for the next refresh
+    new_prev_histories = [h for h in new_prev_histories if not h.empty]
+    if new_prev_histories:
+        if not prev_day_cache.empty:
+            new_prev_histories.insert(0, prev_day_cache)
+        save_cached_history(prev_day.date(), pd.concat(new_prev_histories, ignore_index=True))
     
-    # Create DataFrame from results
-    df = pd.DataFrame(results)
-    df = df.set_index('symbol')
+    if histories:
+        df = calculate_volume_spikes(pd.concat(histories, ignore_index=True), normalized_names,
+                                     prev_day.date(), current_time_ist.date())
+    else:
+        df = pd.DataFrame()
     
-    return df
+    # Check if we got enough real data
+    if len(df) < 5:
+        logger.warning(f"Only found {len(df)} valid stocks. Using sample data.")
+        return sample_data.get_sample_volume_data(), True
+    
+    return df, False
 
-def get_market_cap(symbol):
-    """Get market cap for a single symbol with improved error handling"""
+def get_market_cap(symbol, force_refresh=False, use_cache=True):
+    """
+    Get market cap for a single symbol with improved error handling
+    
+    Args:
+        symbol: Yahoo Finance symbol
+        force_refresh: Skip the cache and the fallback table and always query Yahoo Finance
+        use_cache: Set to False to skip only the cache, e.g. when refreshing stale entries
+        
+    Returns:
+        Market cap in crores, or 0 if unavailable
+    """
     normalized_symbol = normalize_symbol(symbol)
     
     try:
-        # Check if we already have this in the cache
-        if normalized_symbol in MARKET_CAP_CACHE['market_caps']:
-            return MARKET_CAP_CACHE['market_caps'][normalized_symbol]
-            
-        # Try using the API first
-        max_retries = 3
-        retry_delay = 1  # seconds
+        if use_cache and not force_refresh:
+            # Check if we already have this in the cache
+            cached_market_cap = get_cached_market_cap(normalized_symbol)
+            if cached_market_cap is not None:
+                return cached_market_cap
+        
+        if USE_FALLBACK_FIRST and not force_refresh:
+            # Curated symbols have known market caps, so skip the network for them
+            fallback_market_cap = FALLBACK_MARKET_CAPS.get(normalized_symbol)
+            if fallback_market_cap is not None:
+                return fallback_market_cap
+        
+        # Try using the API first; transient HTTP errors are retried by the session's adapter
         market_cap_cr = 0
+        ticker = yf.Ticker(normalized_symbol, session=SESSION)
+        
+        # fast_info only hits the lightweight quote endpoints, unlike the full .info scrape
+        try:
+            market_cap = ticker.fast_info['market_cap'] or 0
+        except (AttributeError, KeyError):
+            # Fall back to the full scrape only when fast_info can't provide it
+            market_cap = ticker.info.get('marketCap', 0) or 0
+        
+        if market_cap > 0:
+            # NSE/BSE listings are already quoted in INR; convert anything else (rough conversion)
+            if not normalized_symbol.endswith(INR_SYMBOL_SUFFIXES):
+                market_cap *= USD_TO_INR
+            
+            # Convert to crores (1 crore = 10 million)
+            market_cap_cr = market_cap / 10000000
         
-        for attempt in range(max_retries):
-            try:
-                ticker = yf.Ticker(normalized_symbol)
-                info = ticker.info
-                
-                # Market cap in USD
-                market_cap_usd = info.get('marketCap', 0)
-                
-                if market_cap_usd > 0:
-                    # Convert to INR (rough conversion)
-                    usd_to_inr = 83  # Approximate exchange rate
-                    market_cap_inr = market_cap_usd * usd_to_inr
-                    
-                    # Convert to crores (1 crore = 10 million)
-                    market_cap_cr = market_cap_inr / 10000000
-                    break
-                else:
-                    # If we got 0 market cap, try again
-                    if attempt < max_retries - 1:
-                        time.sleep(retry_delay)
-            except Exception as e:
-                logger.warning(f"Attempt {attempt+1} failed for market cap of {normalized_symbol}: {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-                
         # If API failed or returned 0, use fallback for known symbols
-        if market_cap_cr <= 0 and normalized_symbol in FALLBACK_MARKET_CAPS:
-            logger.info(f"Using fallback market cap for {normalized_symbol}")
-            market_cap_cr = FALLBACK_MARKET_CAPS[normalized_symbol]
+        if market_cap_cr <= 0:
+            market_cap_cr = FALLBACK_MARKET_CAPS.get(normalized_symbol, 0)
+            if market_cap_cr > 0:
+                logger.info(f"Using fallback market cap for {normalized_symbol}")
             
         return market_cap_cr
     
     except Exception as e:
         logger.error(f"Error getting market cap for {normalized_symbol}: {e}")
         # Use fallback value if available
-        if normalized_symbol in FALLBACK_MARKET_CAPS:
-            return FALLBACK_MARKET_CAPS[normalized_symbol]
-        return 0
+        return FALLBACK_MARKET_CAPS.get(normalized_symbol, 0)
+
+def build_market_cap_frame(symbols, normalized_symbols, market_caps):
+    """Align market caps (keyed by normalized symbol) to the requested symbols in one reindex"""
+    market_cap_cr = pd.Series(market_caps, dtype='float64').reindex(normalized_symbols, fill_value=0)
+    return pd.DataFrame({'market_cap_cr': market_cap_cr.to_numpy()}, index=pd.Index(symbols))
 
 def get_market_caps(symbols, progress_callback=None):
     """
@@ -445,21 +780,25 @@ def get_market_caps(symbols, progress_callback=None):
     Returns:
         DataFrame with market caps
     """
-    # Check if we have a recent cache (less than 1 hour old)
-    cache_valid = (
-        MARKET_CAP_CACHE['timestamp'] is not None and 
-        (datetime.now() - MARKET_CAP_CACHE['timestamp']).total_seconds() < 3600
-    )
-    
-    # Initialize with cached data if available
-    if cache_valid:
-        market_caps = MARKET_CAP_CACHE['market_caps'].copy()
-    else:
-        market_caps = {}
-    
     # Normalize symbols
     normalized_symbols = [normalize_symbol(s) for s in symbols]
     
+    # Initialize with cached data; each symbol expires on its own
+    market_caps = {}
+    stale_symbols = []
+    for symbol in normalized_symbols:
+        cached_market_cap = get_cached_market_cap(symbol)
+        if cached_market_cap is None:
+            # Recently expired values are still served, and refreshed without blocking this call
+            cached_market_cap = get_cached_market_cap(symbol, MARKET_CAP_STALE_WINDOW)
+            if cached_market_cap is not None:
+                stale_symbols.append(symbol)
+        if cached_market_cap is not None:
+            market_caps[symbol] = cached_market_cap
+    
+    if stale_symbols:
+        refresh_market_caps_in_background(stale_symbols)
+    
     # Only fetch data for symbols not in cache
     symbols_to_fetch = [s for s in normalized_symbols if s not in market_caps]
     
@@ -467,33 +806,40 @@ def get_market_caps(symbols, progress_callback=None):
         # If all symbols are already in cache, return immediately
         if progress_callback:
             progress_callback(1.0)  # Indicate complete progress
-        return pd.DataFrame({'market_cap_cr': {s: market_caps.get(normalize_symbol(s), 0) for s in symbols}})
+        return build_market_cap_frame(symbols, normalized_symbols, market_caps)
     
     # Try fetching from Yahoo Finance API
     success_count = 0
+    completed = 0
     total_symbols = len(symbols_to_fetch)
     
-    # Process in batches
-    batch_size = 10
-    for i in range(0, total_symbols, batch_size):
-        batch = symbols_to_fetch[i:i+batch_size]
+    fetched_market_caps = {}
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    
+    # Market cap lookups are pure I/O, so submit every symbol to one pool; the rate limiter paces requests
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_IO_WORKERS, total_symbols)) as executor:
+        future_to_symbol = {executor.submit(get_market_cap, symbol): symbol for symbol in symbols_to_fetch}
         
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            batch_results = list(executor.map(get_market_cap, batch))
+        # Handle each result as soon as it arrives instead of waiting for the slowest symbol
+        for future in concurrent.futures.as_completed(future_to_symbol):
+            symbol = future_to_symbol[future]
+            market_cap = future.result()
+            if market_cap > 0:
+                success_count += 1
+            fetched_market_caps[symbol] = market_cap
             
-            for symbol, market_cap in zip(batch, batch_results):
-                if market_cap > 0:
-                    success_count += 1
-                market_caps[symbol] = market_cap
-                # Update the cache
-                MARKET_CAP_CACHE['market_caps'][symbol] = market_cap
-        
-        # Update progress
-        if progress_callback:
-            progress_callback(min(1.0, (i + batch_size) / total_symbols))
-        
-        # Sleep to prevent rate limiting
-        time.sleep(1)
+            # Update progress
+            completed += 1
+            if progress_callback:
+                progress_callback(completed / total_symbols)
+    
+    # CPU time well below wall time confirms the fetch is I/O-bound
+    logger.debug(f"Market caps for {total_symbols} symbols: {time.perf_counter() - start_wall:.2f}s wall, "
+                 f"{time.process_time() - start_cpu:.2f}s CPU")
+    
+    # Update the cache once for the whole fetch rather than per completed future
+    market_caps.update(fetched_market_caps)
+    set_cached_market_caps(fetched_market_caps)
     
     # If we got very few successful results, use sample data
     if success_count < 5 and len(symbols) > 10:
@@ -501,22 +847,18 @@ def get_market_caps(symbols, progress_callback=None):
         import streamlit as st
         if 'using_sample_data' in st.session_state:
             st.session_state.using_sample_data = True
-        sample_market_caps = sample_data.get_sample_market_caps()
+        sample_market_caps = sample_data.get_sample_market_caps()['market_cap_cr'].to_dict()
         
         # Update our market caps with sample data for missing or zero values
-        for symbol in symbols:
-            normalized = normalize_symbol(symbol)
-            if normalized in sample_market_caps.index and (normalized not in market_caps or market_caps[normalized] <= 0):
-                market_cap = sample_market_caps.loc[normalized, 'market_cap_cr']
-                market_caps[normalized] = market_cap
-                MARKET_CAP_CACHE['market_caps'][normalized] = market_cap
+        sample_fill = {
+            normalized: sample_market_caps[normalized] for normalized in set(normalized_symbols)
+            if normalized in sample_market_caps and market_caps.get(normalized, 0) <= 0
+        }
+        market_caps.update(sample_fill)
+        set_cached_market_caps(sample_fill)
     
-    # Update cache timestamp
-    if not cache_valid:
-        MARKET_CAP_CACHE['timestamp'] = datetime.now()
+    # Persist both caches
+    save_disk_cache()
     
     # Return only the requested symbols
-    result_market_caps = {s: market_caps.get(normalize_symbol(s), 0) for s in symbols}
-    
-    # Create DataFrame from results
-    return pd.DataFrame({'market_cap_cr': result_market_caps})
+    return build_market_cap_frame(symbols, normalized_symbols, market_caps)
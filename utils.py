@@ -1,6 +1,13 @@
-from datetime import datetime, time as dt_time
+from datetime import datetime, time as dt_time, timedelta
 import pytz
 
+# Market hours: 9:15 AM to 3:30 PM
+MARKET_OPEN_TIME = dt_time(9, 15, 0)
+MARKET_CLOSE_TIME = dt_time(15, 30, 0)
+
+# Days back to the previous weekday, indexed by weekday() (Monday goes back to Friday)
+PREV_TRADING_DAY_OFFSETS = (3, 1, 1, 1, 1, 1, 2)
+
 def get_current_time_ist():
     """Get current time in Indian Standard Time (IST)"""
     ist = pytz.timezone('Asia/Kolkata')
@@ -23,13 +30,24 @@ def is_market_open(current_time=None):
     if current_time.weekday() >= 5:  # 5 is Saturday, 6 is Sunday
         return False
     
-    # Market hours: 9:15 AM to 3:30 PM
-    market_open_time = dt_time(9, 15, 0)
-    market_close_time = dt_time(15, 30, 0)
-    
     current_time_only = current_time.time()
     
-    return market_open_time <= current_time_only <= market_close_time
+    return MARKET_OPEN_TIME <= current_time_only <= MARKET_CLOSE_TIME
+
+def get_previous_trading_day(current_time=None):
+    """
+    Get the previous trading day, skipping weekends
+    
+    Args:
+        current_time: datetime object in IST timezone, or None to use current time
+        
+    Returns:
+        datetime of the previous weekday at the same time of day
+    """
+    if current_time is None:
+        current_time = get_current_time_ist()
+    
+    return current_time - timedelta(days=PREV_TRADING_DAY_OFFSETS[current_time.weekday()])
 
 def format_market_cap(market_cap):
     """Format market cap for display"""